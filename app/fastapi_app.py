@@ -1,26 +1,44 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import cv2
 import numpy as np
 import uvicorn
 from ultralytics import YOLO
-import base64
+import pybase64
 import io
+import os
 from PIL import Image
 import json
 from typing import List, Dict, Any, Optional
 import asyncio
 import threading
+from collections import deque
 from pathlib import Path
 import settings
 import helper
 
+import torch
+from torchvision.transforms.v2 import functional as tvf
+
+# Upload GPU direct des frames webcam quand CUDA est disponible
+CUDA_AVAILABLE = torch.cuda.is_available()
+
+# Codec JPEG accéléré (libjpeg-turbo), repli sur OpenCV/PIL sinon
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR, TJSAMP_420
+    jpeg_codec = TurboJPEG()
+except Exception:
+    jpeg_codec = None
+
 # Configuration FastAPI
 app = FastAPI(
     title="Waste Classification Mobile API",
     description="API mobile pour la classification des déchets avec YOLOv8",
-    version="2.0.0"
+    version="2.0.0",
+    # Sérialisation JSON via orjson : les réponses embarquent de grosses
+    # chaînes base64 que le sérialiseur stdlib recopie lentement
+    default_response_class=ORJSONResponse
 )
 
 # Middleware CORS pour React Native
@@ -34,8 +52,40 @@ app.add_middleware(
 
 # État global pour le streaming
 camera_active = False
-current_frame = None
-camera_lock = threading.Lock()
+
+# Slot mono-frame producteur/consommateur : seule la frame la plus
+# récente compte, les intermédiaires sont simplement écrasées ; append()
+# et lecture de deque(maxlen=1) sont atomiques, aucun verrou nécessaire
+raw_frames = deque(maxlen=1)
+frame_event = threading.Event()
+
+# Dernière frame annotée, encodée en JPEG une seule fois par le thread
+# d'inférence : les N clients du stream et /api/webcam/frame partagent
+# les mêmes octets. Le numéro de séquence sous asyncio.Condition permet à
+# chaque client d'attendre la frame suivante sans voler le réveil des
+# autres ni immobiliser un thread du pool partagé par client connecté.
+latest_jpeg = None
+jpeg_seq = 0
+jpeg_condition: Optional[asyncio.Condition] = None
+main_loop: Optional[asyncio.AbstractEventLoop] = None
+
+async def announce_frame():
+    """Réveille les clients du stream en attente d'une nouvelle frame"""
+    async with jpeg_condition:
+        jpeg_condition.notify_all()
+
+def schedule_frame_announce():
+    """Exécuté côté boucle d'événements via call_soon_threadsafe"""
+    asyncio.ensure_future(announce_frame())
+
+# Désactiver l'annotation webcam quand le client ne veut que le JSON
+DRAW_OVERLAY = os.getenv('DRAW_OVERLAY', '1') != '0'
+
+# File de micro-batching pour les requêtes de détection concurrentes ;
+# la taille de lot est partagée avec l'export de l'engine TensorRT
+MAX_BATCH = settings.MAX_BATCH
+BATCH_WINDOW = 0.02  # fenêtre de collecte en secondes
+detection_queue: Optional[asyncio.Queue] = None
 
 # Charger le modèle
 try:
@@ -45,12 +95,24 @@ except Exception as e:
     print(f"❌ Erreur chargement modèle: {e}")
     model = None
 
+# Modèle dédié au flux webcam, spécialisé pour la géométrie fixe 640x480
+try:
+    stream_model = helper.load_stream_model('weights/yoloooo.pt') \
+        if model is not None else None
+except Exception as e:
+    print(f"❌ Erreur chargement modèle webcam: {e}")
+    stream_model = model
+
+# Cache des noms de classes : évite la résolution d'attribut à chaque boîte
+class_names = model.names if model is not None and hasattr(model, 'names') else {}
+
 # Modèles Pydantic pour la validation
 from pydantic import BaseModel
 
 class DetectionRequest(BaseModel):
     confidence: float = 0.5
     image: Optional[str] = None
+    draw: bool = True
 
 class DetectionResponse(BaseModel):
     success: bool
@@ -63,6 +125,96 @@ class WebcamStatus(BaseModel):
     active: bool
     message: str
 
+def decode_image(image_bytes) -> np.ndarray:
+    """Décode des octets image (bytes ou bytearray) en tableau numpy BGR.
+
+    Le JPEG (cas de loin majoritaire depuis l'app mobile) passe par
+    TurboJPEG quand il est disponible ; les autres formats par PIL.
+    Ultralytics attend des tableaux numpy en ordre BGR : la sortie PIL
+    (RGB) est convertie une seule fois, ici.
+    """
+    if jpeg_codec is not None and image_bytes[:2] == b'\xff\xd8':
+        return jpeg_codec.decode(image_bytes, pixel_format=TJPF_BGR)
+    img_np = np.array(Image.open(io.BytesIO(image_bytes)))
+    if len(img_np.shape) == 3 and img_np.shape[2] == 3:
+        img_np = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
+    return img_np
+
+def encode_jpeg(image: np.ndarray) -> bytes:
+    """Encode une image BGR en JPEG (TurboJPEG si disponible, sinon OpenCV)"""
+    if jpeg_codec is not None:
+        # Sous-échantillonnage chroma 4:2:0 : même réglage que cv2.imencode
+        return jpeg_codec.encode(image, quality=settings.JPEG_QUALITY,
+                                 jpeg_subsample=TJSAMP_420)
+    _, buffer = cv2.imencode('.jpg', image,
+                             [cv2.IMWRITE_JPEG_QUALITY, settings.JPEG_QUALITY])
+    return buffer.tobytes()
+
+# Stream CUDA dédié aux requêtes HTTP : les lancements de kernels ne se
+# sérialisent pas avec ceux du thread d'inférence webcam
+inference_stream = torch.cuda.Stream() if CUDA_AVAILABLE else None
+
+def run_predict(images, conf_value):
+    """Exécute model.predict sous inference_mode, sur le stream dédié"""
+    # verbose=False : le log par inférence d'Ultralytics tient le GIL
+    with torch.inference_mode():
+        if inference_stream is not None:
+            with torch.cuda.stream(inference_stream):
+                results = model.predict(images, conf=conf_value, verbose=False)
+            inference_stream.synchronize()
+            return results
+        return model.predict(images, conf=conf_value, verbose=False)
+
+# Micro-batching : regrouper N requêtes concurrentes en un seul predict()
+async def detection_batch_worker():
+    """Tâche de fond qui draine la file et lance un predict par lot"""
+    loop = asyncio.get_event_loop()
+    while True:
+        first_item = await detection_queue.get()
+        batch = [first_item]
+        deadline = asyncio.get_event_loop().time() + BATCH_WINDOW
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - asyncio.get_event_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(detection_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Grouper par seuil de confiance : un predict par groupe
+        groups: Dict[float, list] = {}
+        for item in batch:
+            groups.setdefault(item[1], []).append(item)
+
+        for conf_value, items in groups.items():
+            try:
+                # predict part dans un thread : la boucle d'événements
+                # reste libre pour accepter les requêtes suivantes
+                results = await loop.run_in_executor(
+                    None, run_predict, [img for img, _, _ in items], conf_value)
+                for (_, _, future), result in zip(items, results):
+                    if not future.done():
+                        future.set_result([result])
+            except Exception as e:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+async def batched_predict(img_np: np.ndarray, confidence: float):
+    """Soumet une image à la file de batching et attend son résultat"""
+    future = asyncio.get_event_loop().create_future()
+    await detection_queue.put((img_np, confidence, future))
+    return await future
+
+@app.on_event("startup")
+async def start_batch_worker():
+    global detection_queue, jpeg_condition, main_loop
+    detection_queue = asyncio.Queue()
+    jpeg_condition = asyncio.Condition()
+    main_loop = asyncio.get_event_loop()
+    asyncio.create_task(detection_batch_worker())
+
 # Routes de l'API
 @app.get("/")
 async def root():
@@ -95,7 +247,7 @@ async def model_info():
     
     return {
         "model_name": "YOLOv8 Waste Classification",
-        "classes": model.names if hasattr(model, 'names') else {},
+        "classes": class_names,
         "input_size": getattr(model, 'imgsz', 640)
     }
 
@@ -109,16 +261,18 @@ async def detect_image(request: DetectionRequest):
         if not request.image:
             raise HTTPException(status_code=400, detail="No image provided")
         
-        # Décoder l'image base64
-        image_data = request.image
-        if 'base64,' in image_data:
-            image_data = image_data.split('base64,')[1]
-        
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        img_np = np.array(image)
+        # Extraire la charge utile après l'en-tête data-URL en un seul
+        # scan, sans liste intermédiaire
+        image_data = request.image.partition('base64,')[2] or request.image
+
+        # Décodage base64 puis image hors de la boucle d'événements :
+        # sur les grosses photos, chacun bloque plusieurs millisecondes
+        loop = asyncio.get_event_loop()
+        image_bytes = await loop.run_in_executor(
+            None, pybase64.b64decode, image_data, None, True)
+        img_np = await loop.run_in_executor(None, decode_image, image_bytes)
         
-        return await process_detection(img_np, request.confidence)
+        return await process_detection(img_np, request.confidence, draw=request.draw)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -136,49 +290,65 @@ async def detect_upload(
         if not file.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="File must be an image")
         
-        # Lire et convertir l'image
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-        img_np = np.array(image)
+        # Lire l'image en flux par blocs : évite la copie supplémentaire
+        # d'un read() monolithique sur les gros fichiers
+        contents = bytearray()
+        while chunk := await file.read(1 << 20):
+            contents += chunk
+        # Décodage image hors de la boucle d'événements
+        img_np = await asyncio.get_event_loop().run_in_executor(
+            None, decode_image, contents)
         
         return await process_detection(img_np, confidence)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def process_detection(img_np: np.ndarray, confidence: float) -> DetectionResponse:
+async def process_detection(img_np: np.ndarray, confidence: float,
+                            draw: bool = True) -> DetectionResponse:
     """Traite la détection et retourne les résultats"""
     try:
-        # Conversion BGR pour OpenCV
-        if len(img_np.shape) == 3 and img_np.shape[2] == 3:
-            img_np = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-        
-        # Prédiction YOLO
-        results = model.predict(img_np, conf=confidence)
-        
+        # Les images arrivent déjà en BGR (decode_image, frames cv2) :
+        # aucune conversion de couleur dans le chemin d'inférence
+
+        # Prédiction YOLO (via la file de micro-batching)
+        results = await batched_predict(img_np, confidence)
+
         detections = []
-        result_image = img_np.copy()
-        
+        names = class_names
+
         for r in results:
             boxes = r.boxes
-            if boxes is not None:
-                # Dessiner les boîtes sur l'image
-                result_image = r.plot()
-                
-                for box in boxes:
-                    detection = {
-                        'class': model.names[int(box.cls)],
-                        'class_id': int(box.cls),
-                        'confidence': float(box.conf),
-                        'bbox': box.xywhn[0].tolist() if box.xywhn.numel() > 0 else [],
-                        'bbox_pixels': box.xyxy[0].tolist() if box.xyxy.numel() > 0 else []
+            if boxes is not None and len(boxes) > 0:
+                # Extraction vectorisée : quatre transferts tensor→liste
+                # pour tout le lot au lieu de quatre indexations par boîte
+                cls_ids = boxes.cls.int().tolist()
+                confs = boxes.conf.tolist()
+                bboxes = boxes.xywhn.tolist()
+                bboxes_px = boxes.xyxy.tolist()
+
+                detections.extend(
+                    {
+                        'class': names[cls_id],
+                        'class_id': cls_id,
+                        'confidence': conf,
+                        'bbox': bbox,
+                        'bbox_pixels': bbox_px
                     }
-                    detections.append(detection)
-        
-        # Convertir l'image résultat en base64
-        _, buffer = cv2.imencode('.jpg', result_image)
-        image_base64 = base64.b64encode(buffer).decode('utf-8')
-        
+                    for cls_id, conf, bbox, bbox_px
+                    in zip(cls_ids, confs, bboxes, bboxes_px)
+                )
+
+        # Dessiner toutes les boîtes en une seule passe puis encoder en base64
+        image_base64 = None
+        if draw:
+            # plot() conserve l'ordre BGR de l'entrée, prêt pour l'encodage
+            result_image = results[0].plot() if detections else img_np
+            # Encodage JPEG hors de la boucle d'événements
+            jpeg_bytes = await asyncio.get_event_loop().run_in_executor(
+                None, encode_jpeg, result_image)
+            image_base64 = pybase64.b64encode_as_string(jpeg_bytes)
+
         return DetectionResponse(
             success=True,
             detections=detections,
@@ -191,41 +361,108 @@ async def process_detection(img_np: np.ndarray, confidence: float) -> DetectionR
         raise HTTPException(status_code=500, detail=f"Erreur traitement: {str(e)}")
 
 # Fonctions pour le streaming webcam
-def webcam_stream_task(confidence: float):
-    """Thread pour capturer le flux webcam"""
-    global camera_active, current_frame
-    
+def webcam_capture_task():
+    """Thread producteur : capture les frames webcam vers le slot raw_frames"""
+    global camera_active
+
     try:
         cap = cv2.VideoCapture(settings.WEBCAM_PATH)
-        
+        # Pas de backlog côté driver : toujours la frame la plus fraîche
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
         while camera_active:
             ret, frame = cap.read()
-            if ret:
-                # Redimensionner pour performance mobile
-                frame = cv2.resize(frame, (640, 480))
-                
-                # Détection en temps réel
-                results = model.predict(frame, conf=confidence)
-                
-                # Dessiner les résultats
-                for r in results:
-                    frame = r.plot()
-                
-                with camera_lock:
-                    current_frame = frame
-            else:
+            if not ret:
                 break
-            
-            # Limiter à ~10 FPS
-            cv2.waitKey(100)
-        
+            raw_frames.append(frame)
+            frame_event.set()
+
         cap.release()
-        print("📹 Stream webcam arrêté")
-        
+        print("📹 Capture webcam arrêtée")
+
     except Exception as e:
         print(f"❌ Erreur webcam: {e}")
         camera_active = False
 
+def webcam_inference_task(confidence: float):
+    """Thread consommateur : inférence sur la frame la plus récente"""
+    global camera_active, latest_jpeg, jpeg_seq
+
+    try:
+        # Buffers de redimensionnement préalloués, utilisés en alternance
+        # d'une frame à l'autre
+        resize_buffers = (np.empty((480, 640, 3), dtype=np.uint8),
+                          np.empty((480, 640, 3), dtype=np.uint8))
+        buffer_index = 0
+
+        # Staging épinglé : la copie H2D part en DMA sans bloquer le CPU,
+        # qui enchaîne directement sur la capture de la frame suivante.
+        # Alloué à la première frame, quand la taille de capture est connue.
+        pinned_frame = None
+
+        while camera_active:
+            # Attendre une nouvelle frame du producteur
+            if not frame_event.wait(timeout=1.0):
+                continue
+            frame_event.clear()
+
+            try:
+                frame = raw_frames.pop()
+            except IndexError:
+                continue
+
+            if CUDA_AVAILABLE:
+                # Transfert H2D non bloquant de la frame brute depuis le
+                # buffer épinglé ; BGR→RGB, CHW, redimensionnement 640x480
+                # et normalisation s'exécutent ensuite entièrement sur GPU
+                if pinned_frame is None or pinned_frame.shape != frame.shape:
+                    pinned_frame = torch.empty(frame.shape, dtype=torch.uint8,
+                                               pin_memory=True)
+                pinned_frame.copy_(torch.from_numpy(frame))
+                gpu_frame = pinned_frame.to('cuda', non_blocking=True)
+                gpu_frame = gpu_frame.flip(-1).permute(2, 0, 1)
+                gpu_frame = tvf.resize(gpu_frame, [480, 640], antialias=True)
+                model_input = gpu_frame.unsqueeze(0).float().div_(255.0)
+                display_frame = frame
+            else:
+                # Redimensionner côté CPU, sans réallocation
+                resized = resize_buffers[buffer_index]
+                buffer_index ^= 1
+                cv2.resize(frame, (640, 480), dst=resized)
+                model_input = resized
+                display_frame = resized
+
+            # Détection en temps réel, sans suivi autograd, sur l'engine
+            # spécialisé pour la géométrie webcam
+            with torch.inference_mode():
+                results = stream_model.predict(model_input, conf=confidence,
+                                               verbose=False)
+
+            # Dessiner les résultats (une seule passe, optionnelle)
+            if DRAW_OVERLAY:
+                frame = results[0].plot()
+                if CUDA_AVAILABLE:
+                    # plot() suit l'ordre RGB du tenseur d'entrée :
+                    # repasser en BGR avant l'encodage JPEG
+                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+            else:
+                frame = display_frame
+
+            # Encoder en JPEG une seule fois, ici : tous les clients du
+            # stream et /api/webcam/frame partagent ces octets. Les deux
+            # affectations sont atomiques sous le GIL ; la notification
+            # part côté boucle d'événements
+            latest_jpeg = encode_jpeg(frame)
+            jpeg_seq += 1
+            if main_loop is not None:
+                main_loop.call_soon_threadsafe(schedule_frame_announce)
+
+        print("📹 Inférence webcam arrêtée")
+
+    except Exception as e:
+        print(f"❌ Erreur inférence webcam: {e}")
+        camera_active = False
+
 @app.post("/api/webcam/start")
 async def webcam_start(confidence: float = 0.5):
     """Démarrer le streaming webcam"""
@@ -238,10 +475,12 @@ async def webcam_start(confidence: float = 0.5):
         raise HTTPException(status_code=500, detail="Model not loaded")
     
     camera_active = True
-    # Démarrer le thread webcam
-    thread = threading.Thread(target=webcam_stream_task, args=(confidence,))
-    thread.daemon = True
-    thread.start()
+    # Démarrer les threads capture et inférence
+    for target, args in ((webcam_capture_task, ()),
+                         (webcam_inference_task, (confidence,))):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
     
     return {
         "status": "started", 
@@ -272,17 +511,26 @@ async def webcam_status():
 async def webcam_stream():
     """Streaming MJPEG pour la webcam"""
     async def generate_frames():
+        last_seq = 0
+
         while camera_active:
-            with camera_lock:
-                if current_frame is not None:
-                    # Encoder en JPEG
-                    _, buffer = cv2.imencode('.jpg', current_frame)
-                    frame_data = buffer.tobytes()
-                    
-                    yield (b'--frame\r\n'
-                           b'Content-Type: image/jpeg\r\n\r\n' + frame_data + b'\r\n')
-            
-            await asyncio.sleep(0.1)  # ~10 FPS
+            # Attendre la prochaine frame déjà encodée, notifiée par le
+            # thread d'inférence ; le timeout permet de voir l'arrêt caméra
+            async with jpeg_condition:
+                try:
+                    await asyncio.wait_for(
+                        jpeg_condition.wait_for(lambda: jpeg_seq != last_seq),
+                        timeout=1.0)
+                except asyncio.TimeoutError:
+                    continue
+                frame_data = latest_jpeg
+                last_seq = jpeg_seq
+
+            if frame_data is None:
+                continue
+
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame_data + b'\r\n')
     
     return StreamingResponse(
         generate_frames(),
@@ -294,19 +542,18 @@ async def webcam_frame():
     """Récupérer une frame unique de la webcam"""
     if not camera_active:
         raise HTTPException(status_code=400, detail="Webcam not active")
-    
-    with camera_lock:
-        if current_frame is None:
-            raise HTTPException(status_code=404, detail="No frame available")
-        
-        _, buffer = cv2.imencode('.jpg', current_frame)
-        image_base64 = base64.b64encode(buffer).decode('utf-8')
-        
-        return {
-            "success": True,
-            "image": image_base64,
-            "timestamp": asyncio.get_event_loop().time()
-        }
+
+    if latest_jpeg is None:
+        raise HTTPException(status_code=404, detail="No frame available")
+
+    # Réutiliser le JPEG déjà encodé par le thread d'inférence
+    image_base64 = pybase64.b64encode_as_string(latest_jpeg)
+
+    return {
+        "success": True,
+        "image": image_base64,
+        "timestamp": asyncio.get_event_loop().time()
+    }
 
 # Routes pour les vidéos stockées
 @app.get("/api/videos/list")
@@ -355,7 +602,7 @@ async def detect_video(video_name: str, confidence: float = 0.5):
 # Gestion des erreurs globales
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content={"success": False, "error": str(exc)}
     )
@@ -365,5 +612,10 @@ if __name__ == "__main__":
         "fastapi_app:app",
         host="0.0.0.0",
         port=8000,
-        reload=True
+        # Pas de reload en production : le watcher de fichiers coûte du CPU
+        # et chaque redémarrage recharge le modèle
+        workers=int(os.getenv("UVICORN_WORKERS", "1")),
+        # Boucle uvloop + parseur httptools (fournis par uvicorn[standard])
+        loop="uvloop",
+        http="httptools"
     )
\ No newline at end of file
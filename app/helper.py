@@ -4,6 +4,10 @@ import cv2
 import pafy
 import pickle
 import settings
+import shutil
+import fcntl
+from contextlib import contextmanager
+from pathlib import Path
 
 #loaded_model=pickle.load(open('weights/yolov8.pkl', 'rb'))
 with open('weights/yolov8 (1).pkl', 'rb') as file:
@@ -11,20 +15,195 @@ with open('weights/yolov8 (1).pkl', 'rb') as file:
 
 
 
+@contextmanager
+def _export_lock(target_path):
+    """
+    Cross-process lock serializing exports of the given model file.
+
+    With UVICORN_WORKERS > 1 every worker imports the app at the same time
+    and would race to build the same missing engine/onnx files, loading a
+    partially written model or deleting each other's temporary files. The
+    first worker to take the lock performs the export; the others block on
+    it, then find the finished file and simply load it.
+
+    Parameters:
+        target_path (Path): The model file whose export must be serialized.
+    """
+    lock_path = target_path.with_suffix(target_path.suffix + '.lock')
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def export_engine(weights_path, imgsz=None, batch=1, dynamic=False):
+    """
+    Exports the .pt weights to a TensorRT engine file if it does not exist yet.
+
+    The engine is built with a fixed input size so TensorRT can specialize its
+    kernels. FP16 is used by default; INT8 is enabled through settings when
+    calibration data is staged under weights/calib/ and described by calib.yaml.
+    Each input geometry gets its own engine file, e.g. yoloooo_480x640.engine
+    for the webcam shape. The shared HTTP engine is exported with a dynamic
+    batch axis so micro-batched requests fit its bindings.
+
+    Parameters:
+        weights_path (Path): The path to the .pt weights file.
+        imgsz (int or tuple): The fixed input size (h, w); defaults to
+            settings.MODEL_IMGSZ.
+        batch (int): The (maximum) batch size baked into the engine.
+        dynamic (bool): Whether the engine accepts variable batch sizes
+            up to `batch`.
+
+    Returns:
+        The path to the TensorRT engine file.
+    """
+    if imgsz is None:
+        imgsz = settings.MODEL_IMGSZ
+    if isinstance(imgsz, int):
+        engine_path = weights_path.with_suffix('.engine')
+    else:
+        engine_path = weights_path.with_name(
+            f"{weights_path.stem}_{imgsz[0]}x{imgsz[1]}.engine")
+    if not engine_path.exists():
+        with _export_lock(engine_path):
+            # Another worker may have finished the build while we waited
+            if engine_path.exists():
+                return engine_path
+            export_args = dict(
+                format='engine',
+                half=not settings.TENSORRT_INT8,
+                int8=settings.TENSORRT_INT8,
+                imgsz=imgsz,
+                batch=batch,
+                dynamic=dynamic,
+                workspace=4,
+            )
+            if settings.TENSORRT_INT8:
+                export_args['data'] = settings.TENSORRT_CALIB_DATA
+            if engine_path == weights_path.with_suffix('.engine'):
+                YOLO(str(weights_path)).export(**export_args)
+            else:
+                # L'export écrit toujours <stem>.engine : exporter depuis une
+                # copie des poids nommée par géométrie pour ne pas écraser
+                # l'engine partagé déjà construit
+                geometry_weights = engine_path.with_suffix('.pt')
+                shutil.copyfile(weights_path, geometry_weights)
+                try:
+                    YOLO(str(geometry_weights)).export(**export_args)
+                finally:
+                    geometry_weights.unlink(missing_ok=True)
+    return engine_path
+
+
+def export_onnx(weights_path):
+    """
+    Exports the .pt weights to an ONNX model file if it does not exist yet.
+
+    Ultralytics runs .onnx weights through ONNX Runtime, which picks the
+    best available execution provider (OpenVINO or CUDA when installed,
+    default CPU otherwise). When ONNX_INT8 is enabled in settings the
+    exported graph is additionally dynamic-range quantized to INT8, which
+    roughly halves CPU inference latency versus FP32. The graph keeps a
+    dynamic batch axis so micro-batched requests fit it, like the shared
+    TensorRT engine.
+
+    Parameters:
+        weights_path (Path): The path to the .pt weights file.
+
+    Returns:
+        The path to the ONNX model file.
+    """
+    onnx_path = weights_path.with_suffix('.onnx')
+    if not onnx_path.exists():
+        with _export_lock(onnx_path):
+            # Another worker may have finished the export while we waited
+            if onnx_path.exists():
+                return onnx_path
+            YOLO(str(weights_path)).export(
+                format='onnx',
+                imgsz=settings.MODEL_IMGSZ,
+                batch=settings.MAX_BATCH,
+                dynamic=True,
+                simplify=True,
+            )
+            if settings.ONNX_INT8:
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                int8_path = onnx_path.with_suffix('.int8.onnx')
+                quantize_dynamic(str(onnx_path), str(int8_path),
+                                 weight_type=QuantType.QInt8)
+                int8_path.replace(onnx_path)
+    return onnx_path
+
+
 def load_model(model_path):
     """
     Loads a YOLO object detection model from the specified model_path.
 
+    The backend is chosen through settings.MODEL_BACKEND: 'engine' exports
+    the weights once to a TensorRT engine (GPU), 'onnx' exports them to an
+    INT8-quantized ONNX model run by ONNX Runtime (CPU deployments), and
+    'pt' loads the raw PyTorch weights. When the TensorRT export fails
+    (typically: no CUDA device) the loader falls through to the ONNX INT8
+    path, so CPU-only boxes get the quantized runtime instead of raw FP32
+    PyTorch; only if that also fails are the .pt weights loaded.
+
     Parameters:
         model_path (str): The path to the YOLO model file.
 
     Returns:
         A YOLO object detection model.
     """
-    model = YOLO('weights/yoloooo.pt')
+    weights_path = Path('weights/yoloooo.pt')
+    backend = getattr(settings, 'MODEL_BACKEND', 'pt')
+    if backend == 'engine':
+        try:
+            return YOLO(str(export_engine(weights_path,
+                                          batch=settings.MAX_BATCH,
+                                          dynamic=True)))
+        except Exception as e:
+            print(f"TensorRT engine unavailable ({e}), trying ONNX Runtime")
+            backend = 'onnx'
+    if backend == 'onnx':
+        try:
+            return YOLO(str(export_onnx(weights_path)))
+        except Exception as e:
+            print(f"ONNX export unavailable ({e}), falling back to PyTorch weights")
+    model = YOLO(str(weights_path))
     return model
 
 
+def load_stream_model(model_path):
+    """
+    Loads the model specialized for the fixed webcam input geometry.
+
+    With the TensorRT backend, a second engine is built for exactly the
+    640x480 webcam shape (settings.WEBCAM_IMGSZ), so TRT selects kernels
+    for that geometry instead of padding frames up to the square 640
+    engine. When the export fails the fallback is the raw .pt weights —
+    never the shared static engine, whose bindings would reject the raw
+    480x640 tensors the webcam path feeds on CUDA. Other backends use the
+    shared model, which is shape-flexible there.
+
+    Parameters:
+        model_path (str): The path to the YOLO model file.
+
+    Returns:
+        A YOLO object detection model.
+    """
+    weights_path = Path('weights/yoloooo.pt')
+    if getattr(settings, 'MODEL_BACKEND', 'pt') == 'engine':
+        try:
+            return YOLO(str(export_engine(weights_path,
+                                          imgsz=settings.WEBCAM_IMGSZ)))
+        except Exception as e:
+            print(f"Webcam engine unavailable ({e}), falling back to PyTorch weights")
+        return YOLO(str(weights_path))
+    return load_model(model_path)
+
+
 def display_tracker_options():
     display_tracker = st.radio("Display Tracker", ('Yes', 'No'))
     is_display_tracker = True if display_tracker == 'Yes' else False
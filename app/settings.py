@@ -50,5 +50,25 @@ MODEL_DIR = './weights'
 DETECTION_MODEL = MODEL_DIR+'yolov8 (1).pkl'
 #SEGMENTATION_MODEL = MODEL_DIR+'yolov8n-seg.pt'
 
+# Backend d'inférence : 'engine' (TensorRT, GPU), 'onnx' (ONNX Runtime,
+# déploiement CPU avec EP OpenVINO/CUDA) ou 'pt' (PyTorch brut)
+MODEL_BACKEND = 'engine'
+MODEL_IMGSZ = 640
+# Taille maximale des lots de requêtes HTTP micro-batchées : l'engine
+# partagé est exporté en batch dynamique jusqu'à cette valeur
+MAX_BATCH = 8
+# Géométrie fixe (h, w) du flux webcam, pour l'engine spécialisé
+WEBCAM_IMGSZ = (480, 640)
+
+# TensorRT config (FP16 par défaut, INT8 avec frames de calibration)
+TENSORRT_INT8 = False
+TENSORRT_CALIB_DATA = MODEL_DIR + '/calib.yaml'
+
+# ONNX config (quantification dynamique INT8 des poids)
+ONNX_INT8 = True
+
 # Webcam
 WEBCAM_PATH = 0
+
+# Qualité JPEG des réponses (suffisant pour l'affichage mobile)
+JPEG_QUALITY = 80